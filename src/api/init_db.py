@@ -0,0 +1,19 @@
+"""
+One-off database schema initialisation.
+
+Workers only create tables at startup when DB_AUTO_CREATE=1, so staging and
+production create them once per deploy instead (docker-compose runs this as
+the db-init service):
+
+    python -m api.init_db
+"""
+from api import models
+from api.database import engine
+
+def create_tables():
+    """Create any missing tables; safe to run repeatedly"""
+    models.Base.metadata.create_all(bind=engine)
+
+if __name__ == "__main__":
+    create_tables()
+    print("database_init: tables created")
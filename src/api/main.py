@@ -1,11 +1,16 @@
 from fastapi import FastAPI, Request
 from api.routes import router
 from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
-from starlette.responses import Response
+from starlette.responses import JSONResponse, Response
+import asyncio
+import atexit
+import gzip
 import logging
-import json
+import orjson
+import os
+import queue
 import time
-from api import models  # Ensure models are imported
+from api import init_db, models  # Ensure models are imported
 from api.database import engine
 from api.telemetry import (
     setup_telemetry, get_tracer,
@@ -17,19 +22,68 @@ from api.telemetry import (
     active_connections,
     custom_registry,
     # Import helper functions for consistent labeling
-    normalize_route,
     get_error_class,
 )
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 from opentelemetry import trace
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
 
-# Initialize Logging First - Use JSON formatter
+# Hot-path bindings: monotonic clock for latency histograms and pre-resolved
+# OpenTelemetry lookups so the middleware avoids repeated attribute access
+_perf = time.perf_counter
+_get_current_span = trace.get_current_span
+_ERROR_STATUS = trace.Status(trace.StatusCode.ERROR)
+
+def _format_span_ids(span_context):
+    """Return (trace_id, span_id) as hex strings, or (None, None) for invalid contexts"""
+    if not span_context.is_valid:
+        return None, None
+    return f"{span_context.trace_id:032x}", f"{span_context.span_id:016x}"
+
+# Bound metric children keyed by label values, so each request skips the
+# `.labels()` hashing and lookup. Capped so unmatched paths cannot grow them forever.
+_LABEL_CACHE_MAX = 1024
+_req_children = {}
+_dur_children = {}
+
+# Label for requests that matched no registered route, so arbitrary
+# user-supplied paths never become metric label values
+_UNMATCHED_ROUTE = "unmatched"
+
+def _route_template(scope):
+    """Return the matched route template (e.g. /orders/{order_id}/process)"""
+    # The router stores the matched route in the scope; no per-request regex needed
+    return getattr(scope.get("route"), "path", _UNMATCHED_ROUTE)
+
+# Initialize Logging First - Use JSON formatters
+# orjson encodes in C and returns bytes; decode once for the stream handler
 class JsonFormatter(logging.Formatter):
+    """Generic formatter for third-party records with plain string messages"""
     def format(self, record):
-        if isinstance(record.msg, dict):
-            return json.dumps(record.msg)
-        return json.dumps({"message": record.getMessage(), "level": record.levelname})
+        return orjson.dumps({"message": record.getMessage(), "level": record.levelname}).decode()
+
+class DictJsonFormatter(logging.Formatter):
+    """Fast formatter for StructuredLogger records, whose message is always a dict"""
+    def format(self, record):
+        return orjson.dumps(record.msg).decode()
+
+# Parent logger for StructuredLogger instances; they bypass the root handler
+STRUCTURED_LOGGER_NAME = "structured"
+_STRUCTURED_PREFIX = STRUCTURED_LOGGER_NAME + "."
+
+class LoggerNameJsonFormatter(logging.Formatter):
+    """Format StructuredLogger records as dicts and everything else generically"""
+    def __init__(self):
+        super().__init__()
+        self.structured_formatter = DictJsonFormatter()
+        self.generic_formatter = JsonFormatter()
+    
+    def format(self, record):
+        if record.name.startswith(_STRUCTURED_PREFIX):
+            return self.structured_formatter.format(record)
+        return self.generic_formatter.format(record)
 
 # Configure root logger
 root_logger = logging.getLogger()
@@ -37,61 +91,91 @@ root_logger.setLevel(logging.INFO)
 # Remove existing handlers
 for handler in root_logger.handlers:
     root_logger.removeHandler(handler)
-# Add JSON console handler
+# Add a JSON console handler behind a queue so request handlers only enqueue
+# records; formatting and the blocking stream write happen on a single listener
+# thread, which keeps lines from both logger trees in emission order
+class RecordQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Keep dict messages intact for DictJsonFormatter instead of pre-formatting
+        return record
+
 console_handler = logging.StreamHandler()
-console_handler.setFormatter(JsonFormatter())
-root_logger.addHandler(console_handler)
+console_handler.setFormatter(LoggerNameJsonFormatter())
+log_queue = queue.SimpleQueue()
+
+# Third-party records go through the stock prepare(), which resolves %-args and
+# exc_info on the calling thread so the listener never sees mutable arguments
+root_logger.addHandler(QueueHandler(log_queue))
+
+structured_root_logger = logging.getLogger(STRUCTURED_LOGGER_NAME)
+structured_root_logger.propagate = False
+# LOG_LEVEL (e.g. WARNING in prod) lets StructuredLogger skip filtered records early
+_log_level = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())
+structured_root_logger.setLevel(_log_level if isinstance(_log_level, int) else logging.INFO)
+structured_root_logger.addHandler(RecordQueueHandler(log_queue))
+
+log_listener = QueueListener(log_queue, console_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 logger = logging.getLogger(__name__)
 
 # Create structured logger
 class StructuredLogger:
     def __init__(self, name):
-        self.logger = logging.getLogger(name)
-        self.logger.setLevel(logging.INFO)
+        self.logger = logging.getLogger(f"{STRUCTURED_LOGGER_NAME}.{name}")
+        # Level is inherited from the "structured" parent, set from LOG_LEVEL
     
-    def info(self, msg, **kwargs):
-        # Add trace context
-        span = trace.get_current_span()
-        span_context = span.get_span_context()
-        
-        # Format as JSON directly
-        log_data = {
+    def _build(self, level, msg, kwargs):
+        # Format as JSON directly; callers that already hold the trace context
+        # pass trace_id/span_id explicitly, so skip the current-span lookup
+        if "trace_id" in kwargs:
+            return {"message": msg, "level": level, **kwargs}
+        trace_id, span_id = _format_span_ids(_get_current_span().get_span_context())
+        return {
             "message": msg,
-            "level": "INFO",
-            "trace_id": format(span_context.trace_id, "032x") if span_context.is_valid else None,
-            "span_id": format(span_context.span_id, "016x") if span_context.is_valid else None,
+            "level": level,
+            "trace_id": trace_id,
+            "span_id": span_id,
             **kwargs
         }
+    
+    def info(self, msg, **kwargs):
+        # Skip building the record entirely when this level is filtered out
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
         # Send as dict rather than string
-        self.logger.info(log_data)
+        self.logger.info(self._build("INFO", msg, kwargs))
     
     def error(self, msg, **kwargs):
-        # Add trace context
-        span = trace.get_current_span()
-        span_context = span.get_span_context()
-        
-        # Format as JSON directly
-        log_data = {
-            "message": msg,
-            "level": "ERROR",
-            "trace_id": format(span_context.trace_id, "032x") if span_context.is_valid else None,
-            "span_id": format(span_context.span_id, "016x") if span_context.is_valid else None,
-            **kwargs
-        }
+        # Skip building the record entirely when this level is filtered out
+        if not self.logger.isEnabledFor(logging.ERROR):
+            return
         # Send as dict rather than string
-        self.logger.error(log_data)
+        self.logger.error(self._build("ERROR", msg, kwargs))
 
 # Replace logger with structured logger
 structured_logger = StructuredLogger(__name__)
 
-# Create FastAPI app
-app = FastAPI()
+# Auto-create tables on startup (opt-in, so workers don't all hit the DB on boot)
+def create_tables():
+    if os.getenv("DB_AUTO_CREATE") != "1":
+        structured_logger.info("database_init", status="skipped", action="check_tables")
+        return
+    structured_logger.info("database_init", status="starting", action="check_tables")
+    init_db.create_tables()
+    structured_logger.info("database_init", status="complete", action="tables_created")
 
-# Auto-create tables on startup
-structured_logger.info("database_init", status="starting", action="check_tables")
-models.Base.metadata.create_all(bind=engine)
-structured_logger.info("database_init", status="complete", action="tables_created")
+@asynccontextmanager
+async def lifespan(app):
+    create_tables()
+    # Demo spans/logs are opt-in so production cold starts stay quiet
+    if os.getenv("GENERATE_STARTUP_TEST_LOGS") == "1":
+        generate_test_logs()
+    yield
+
+# Create FastAPI app
+app = FastAPI(lifespan=lifespan)
 
 # Register API routes
 app.include_router(router)
@@ -99,75 +183,89 @@ app.include_router(router)
 # Initialize OpenTelemetry (will use OTEL_SERVICE_NAME environment variable)
 setup_telemetry()
 
+# Get a tracer once; request handlers reuse it instead of hitting the provider
+tracer = get_tracer(__name__)
+
 # Instrument FastAPI and SQLAlchemy AFTER routes are registered
 # Disable FastAPI's automatic metrics to avoid conflicts
 FastAPIInstrumentor.instrument_app(app, excluded_urls="/metrics")
 SQLAlchemyInstrumentor().instrument(engine=engine)
 
-@app.middleware("http")
-async def metrics_middleware(request: Request, call_next):
+class MetricsMiddleware:
     """
-    Middleware to collect Prometheus metrics and OpenTelemetry traces.
+    Pure ASGI middleware to collect Prometheus metrics and OpenTelemetry traces.
+    
+    Implemented as a plain ASGI app rather than `@app.middleware("http")`, which
+    wraps the handler in BaseHTTPMiddleware and spawns an extra task plus
+    Request/Response objects for every request.
     
     This middleware demonstrates best practices for observability:
-    1. Normalize routes to avoid high cardinality
+    1. Label by route template to avoid high cardinality
     2. Use consistent error classification
     3. Correlate metrics with traces
     4. Proper exception handling
     """
-    start_time = time.time()
-    method = request.method
-    # Use normalized route to avoid high cardinality in metrics
-    route = normalize_route(request.url.path)
     
-    # Increment active connections gauge
-    active_connections.inc()
+    def __init__(self, app):
+        self.app = app
     
-    # Create explicit span for the request
-    tracer = get_tracer(__name__)
-    with tracer.start_as_current_span(
-        f"{method} {route}",
-        attributes={
-            "http.method": method,
-            "http.url": str(request.url),
-            "http.route": route,
-            "http.scheme": request.url.scheme,
-            "http.host": request.url.hostname,
-        },
-    ) as span:
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
         
-        try:
-            response = await call_next(request)
-            status_code = response.status_code
-            
-            # Add response attributes to span
-            span.set_attribute("http.status_code", status_code)
-            span.set_attribute("http.response.size", response.headers.get("content-length", 0))
-            
-            if status_code >= 400:
-                span.set_status(trace.Status(trace.StatusCode.ERROR))
-            
-            # Calculate request duration
-            duration = time.time() - start_time
+        start = _perf()
+        method = scope["method"]
+        
+        # Increment active connections gauge
+        active_connections.inc()
+        
+        # FastAPIInstrumentor already opened a server span for this request and
+        # owns its request attributes (method, scheme, URL); the middleware only
+        # adds what it lacks (route, status, size) at response start
+        span = _get_current_span()
+        # Unsampled spans drop everything, so skip attribute/status work for them
+        recording = span.is_recording()
+        
+        # Trace context for log correlation, shared by success and error paths
+        trace_id, span_id = _format_span_ids(span.get_span_context())
+        # None until http.response.start is sent
+        status_code = None
+        response_size = 0
+        # Set once the final body chunk is sent; anything after that (e.g.
+        # BackgroundTasks) must not count towards the request's metrics
+        response_complete = False
+        
+        def record_response(duration):
+            # Use the route template to avoid high cardinality in metrics
+            route = _route_template(scope)
             
             # Record metrics using best practices
             # 1. Traffic metric
-            http_requests_total.labels(
-                method=method,
-                route=route,  # Normalized route, not full path
-                status_code=status_code
-            ).inc()
+            status_class = get_error_class(status_code)
+            req_key = (method, route, status_class)
+            req_counter = _req_children.get(req_key)
+            if req_counter is None:
+                req_counter = http_requests_total.labels(
+                    method=method,
+                    route=route,  # Route template, not full path
+                    status_code=status_class  # Status class, not specific status
+                )
+                if len(_req_children) < _LABEL_CACHE_MAX:
+                    _req_children[req_key] = req_counter
+            req_counter.inc()
             
             # 2. Latency metric
-            http_request_duration_seconds.labels(
-                method=method,
-                route=route
-            ).observe(duration)
-            
-            # Get trace context for logging correlation
-            span_context = span.get_span_context()
-            trace_id = format(span_context.trace_id, "032x") if span_context.is_valid else None
-            span_id = format(span_context.span_id, "016x") if span_context.is_valid else None
+            dur_key = (method, route)
+            dur_histogram = _dur_children.get(dur_key)
+            if dur_histogram is None:
+                dur_histogram = http_request_duration_seconds.labels(
+                    method=method,
+                    route=route
+                )
+                if len(_dur_children) < _LABEL_CACHE_MAX:
+                    _dur_children[dur_key] = dur_histogram
+            dur_histogram.observe(duration)
             
             # Structured logging with trace correlation
             structured_logger.info(
@@ -183,11 +281,10 @@ async def metrics_middleware(request: Request, call_next):
             
             # 3. Error metrics (if applicable)
             if status_code >= 400:
-                error_class = get_error_class(status_code)
                 http_errors_total.labels(
                     method=method,
                     route=route,
-                    error_code=error_class  # Use error class, not specific status
+                    error_code=status_class  # Use error class, not specific status
                 ).inc()
                 
                 structured_logger.error(
@@ -195,18 +292,90 @@ async def metrics_middleware(request: Request, call_next):
                     method=method,
                     route=route,
                     status_code=status_code,
-                    error_class=error_class,
+                    error_class=status_class,
                     duration_ms=round(duration * 1000, 2),
                     trace_id=trace_id,
                     span_id=span_id
                 )
+        
+        async def send_wrapper(message):
+            nonlocal status_code, response_size, response_complete
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                for name, value in message.get("headers", ()):
+                    if name == b"content-length":
+                        response_size = int(value)
+                        break
+                
+                # Add response attributes now: the instrumentor ends the server
+                # span as soon as the response body has been sent. Routing has
+                # already happened, so the route template is known here.
+                if recording:
+                    # "unmatched" is a metric label only; semconv omits http.route
+                    # when no route matched
+                    matched_route = getattr(scope.get("route"), "path", None)
+                    if matched_route is not None:
+                        span.set_attribute("http.route", matched_route)
+                    span.set_attribute("http.status_code", status_code)
+                    span.set_attribute("http.response.size", response_size)
+                    
+                    if status_code >= 400:
+                        span.set_status(_ERROR_STATUS)
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                # Measure up to the last body chunk, not until the app returns:
+                # the app's await also covers background tasks
+                duration = _perf() - start
+                await send(message)
+                response_complete = True
+                record_response(duration)
+                return
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
             
-            return response
+            # Apps that return without a final body chunk are recorded here
+            if not response_complete:
+                response_complete = True
+                if status_code is not None:
+                    record_response(_perf() - start)
+                else:
+                    # No response was sent at all (e.g. the client disconnected
+                    # early); don't count it as a 5xx or an http_error
+                    structured_logger.info(
+                        "request_no_response",
+                        method=method,
+                        route=_route_template(scope),
+                        trace_id=trace_id,
+                        span_id=span_id
+                    )
             
         except Exception as e:
+            if response_complete:
+                # The response already went out and was recorded; this failure
+                # came from post-response work such as a background task
+                application_errors_total.labels(
+                    error_type=type(e).__name__,
+                    component="background_task"
+                ).inc()
+                
+                structured_logger.error(
+                    "background_task_failed",
+                    method=method,
+                    route=_route_template(scope),
+                    error=str(e),
+                    error_type=type(e).__name__,
+                    trace_id=trace_id,
+                    span_id=span_id
+                )
+                raise
+            
             # Set span to error state
-            span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
-            span.record_exception(e)
+            if recording:
+                span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
+                span.record_exception(e)
+            
+            route = _route_template(scope)
             
             # Record application errors with proper classification
             application_errors_total.labels(
@@ -214,11 +383,6 @@ async def metrics_middleware(request: Request, call_next):
                 component="middleware"
             ).inc()
             
-            # Get trace context for logging
-            span_context = span.get_span_context()
-            trace_id = format(span_context.trace_id, "032x") if span_context.is_valid else None
-            span_id = format(span_context.span_id, "016x") if span_context.is_valid else None
-            
             structured_logger.error(
                 "request_failed",
                 method=method,
@@ -230,35 +394,73 @@ async def metrics_middleware(request: Request, call_next):
             )
             
             # Re-raise the exception
-            raise e
+            raise
         
         finally:
             # Decrement active connections in finally block to ensure it always happens
             active_connections.dec()
 
+app.add_middleware(MetricsMiddleware)
+
 @app.get("/")
-async def root():
+async def root() -> dict[str, str]:
     return {"message": "KodeKloud Record Store API is running1111I222!"}
 
+# Exposition payload cache: (generated_at, payload, gzipped payload or None)
+# Scrapes within the TTL reuse the last encoding instead of walking the registry again
+_METRICS_CACHE_TTL = 1.0
+_metrics_cache = (float("-inf"), b"", None)
+
+def _accepts_gzip(accept_encoding):
+    """Return True if an Accept-Encoding header allows gzip (q=0 means refused)"""
+    qualities = {}
+    for token in accept_encoding.split(","):
+        coding, _, params = token.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    # An explicit gzip entry takes precedence over the "*" wildcard
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
 @app.get("/metrics")
-async def metrics():
-    return Response(generate_latest(custom_registry), media_type=CONTENT_TYPE_LATEST)
+async def metrics(request: Request):
+    global _metrics_cache
+    generated_at, payload, gzipped = _metrics_cache
+    now = time.monotonic()
+    if now - generated_at >= _METRICS_CACHE_TTL:
+        generated_at, payload, gzipped = now, generate_latest(custom_registry), None
+        _metrics_cache = (generated_at, payload, gzipped)
+    
+    if _accepts_gzip(request.headers.get("accept-encoding", "")):
+        # Compress only when a scraper asks for it, once per cached payload
+        if gzipped is None:
+            gzipped = gzip.compress(payload, 1)
+            _metrics_cache = (generated_at, payload, gzipped)
+        return Response(
+            gzipped,
+            media_type=CONTENT_TYPE_LATEST,
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+        )
+    return Response(payload, media_type=CONTENT_TYPE_LATEST, headers={"Vary": "Accept-Encoding"})
 
 @app.get("/health")
-async def health_check():
+async def health_check() -> dict[str, str]:
     return {"status": "healthy", "version": "1.0.0"}
 
 @app.get("/trace-test")
-async def trace_test():
-    tracer = get_tracer(__name__)
+async def trace_test() -> dict[str, str | None]:
     with tracer.start_as_current_span("test-span") as span:
         span.set_attribute("test.attribute", "test-value")
         span.set_attribute("custom.operation", "trace-test")
         
         # Get the current trace and span ID for logging
-        span_context = span.get_span_context()
-        trace_id = format(span_context.trace_id, "032x") if span_context.is_valid else None
-        span_id = format(span_context.span_id, "016x") if span_context.is_valid else None
+        trace_id, span_id = _format_span_ids(span.get_span_context())
         
         # Log with explicit trace context
         structured_logger.info(
@@ -273,12 +475,10 @@ async def trace_test():
         # Create a child span
         with tracer.start_as_current_span("child-span") as child_span:
             child_span.set_attribute("relationship", "child")
-            time.sleep(0.1)  # Add a small delay
+            await asyncio.sleep(0.1)  # Add a small delay without blocking the event loop
             
             # Log from child span
-            child_context = child_span.get_span_context()
-            child_trace_id = format(child_context.trace_id, "032x") if child_context.is_valid else None
-            child_span_id = format(child_context.span_id, "016x") if child_context.is_valid else None
+            child_trace_id, child_span_id = _format_span_ids(child_span.get_span_context())
             
             structured_logger.info(
                 "child_span_executed",
@@ -297,7 +497,6 @@ async def trace_test():
 
 @app.get("/error-test")
 async def error_test():
-    tracer = get_tracer(__name__)
     with tracer.start_as_current_span("error-span") as span:
         span.set_attribute("error", True)
         span.set_attribute("custom.operation", "error-simulation")
@@ -306,9 +505,7 @@ async def error_test():
         span.set_status(trace.Status(trace.StatusCode.ERROR, "Simulated error for testing"))
         
         # Get the current trace and span ID for logging
-        span_context = span.get_span_context()
-        trace_id = format(span_context.trace_id, "032x") if span_context.is_valid else None
-        span_id = format(span_context.span_id, "016x") if span_context.is_valid else None
+        trace_id, span_id = _format_span_ids(span.get_span_context())
         
         structured_logger.error(
             "error_test_executed", 
@@ -321,38 +518,37 @@ async def error_test():
         )
         
         # Simulate an HTTP 500 error
-        return Response(
-            content=json.dumps({
+        return JSONResponse(
+            content={
                 "error": "Simulated error",
                 "trace_id": trace_id,
                 "span_id": span_id
-            }), 
-            status_code=500, 
-            media_type="application/json"
+            },
+            status_code=500
         )
 
-@app.on_event("startup")
-async def generate_test_logs():
+def generate_test_logs():
     # Generate some logs with trace contexts
-    tracer = get_tracer(__name__)
     
     # Generate log with trace context
     with tracer.start_as_current_span("startup-span") as span:
         span.set_attribute("test.attribute", "test-value")
         span.set_attribute("custom.operation", "startup-test")
+        trace_id, span_id = _format_span_ids(span.get_span_context())
         structured_logger.info("Application started", 
                              operation="app_startup",
-                             trace_id=format(span.get_span_context().trace_id, "032x"),
-                             span_id=format(span.get_span_context().span_id, "016x"))
+                             trace_id=trace_id,
+                             span_id=span_id)
     
     # Generate error log with trace context
     with tracer.start_as_current_span("error-test-span") as span:
         span.set_attribute("error", True)
         span.set_attribute("custom.operation", "error-simulation")
+        trace_id, span_id = _format_span_ids(span.get_span_context())
         structured_logger.error("Test error log", 
                              error_type="SimulatedError",
                              operation="error_test",
-                             trace_id=format(span.get_span_context().trace_id, "032x"),
-                             span_id=format(span.get_span_context().span_id, "016x"))
+                             trace_id=trace_id,
+                             span_id=span_id)
 
 structured_logger.info("api_startup", status="complete", version="1.0.0")
@@ -17,6 +17,7 @@ Best Practices Applied:
 
 from prometheus_client import Counter, Histogram, Gauge, CollectorRegistry
 from typing import Optional
+import re
 
 # Create a custom registry to avoid conflicts with default metrics
 # This allows us to control exactly which metrics are exposed
@@ -34,7 +35,7 @@ METRICS_REGISTRY = CollectorRegistry()
 http_requests_total = Counter(
     name='kodekloud_http_requests_total',
     documentation='Total number of HTTP requests received',
-    labelnames=['method', 'route', 'status_code'],
+    labelnames=['method', 'route', 'status_code'],  # status_code: 2xx, 3xx, 4xx, 5xx
     registry=METRICS_REGISTRY
 )
 
@@ -169,6 +170,11 @@ customers_active_total = Gauge(
 # HELPER FUNCTIONS FOR COMMON METRIC PATTERNS
 # =============================================================================
 
+# Route normalization patterns, compiled once at import rather than per request
+_NUMERIC_ID_RE = re.compile(r'/\d+')
+_UUID_RE = re.compile(r'/[a-f0-9\-]{36}')
+_HASH_RE = re.compile(r'/[a-f0-9]{32}')
+
 def normalize_route(path: str) -> str:
     """
     Normalize URL paths to avoid high cardinality in metrics.
@@ -180,16 +186,14 @@ def normalize_route(path: str) -> str:
     
     This prevents creating separate metric series for each unique ID.
     """
-    import re
-    
     # Replace numeric IDs with {id}
-    path = re.sub(r'/\d+', '/{id}', path)
+    path = _NUMERIC_ID_RE.sub('/{id}', path)
     
     # Replace UUIDs with {uuid}
-    path = re.sub(r'/[a-f0-9\-]{36}', '/{uuid}', path)
+    path = _UUID_RE.sub('/{uuid}', path)
     
     # Replace other potential high-cardinality values
-    path = re.sub(r'/[a-f0-9]{32}', '/{hash}', path)
+    path = _HASH_RE.sub('/{hash}', path)
     
     return path
 
@@ -220,11 +224,11 @@ async def metrics_middleware(request: Request, call_next):
         response = await call_next(request)
         status_code = response.status_code
         
-        # Record successful request
+        # Record successful request (status class keeps cardinality low)
         http_requests_total.labels(
             method=method,
             route=route,
-            status_code=status_code
+            status_code=get_error_class(status_code)
         ).inc()
         
         # Record request duration
@@ -17,10 +17,15 @@ router = APIRouter()
 # Create structured logger
 class StructuredLogger:
     def __init__(self, name):
-        self.logger = logging.getLogger(name)
-        self.logger.setLevel(logging.INFO)
+        # Child of the "structured" logger, which main.py wires to the dict JSON formatter
+        self.logger = logging.getLogger(f"structured.{name}")
+        # Level is inherited from the "structured" parent (LOG_LEVEL in main.py)
     
     def info(self, msg, **kwargs):
+        # Skip building the record entirely when this level is filtered out
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        
         # Add trace context
         span = trace.get_current_span()
         span_context = span.get_span_context()
@@ -37,6 +42,10 @@ class StructuredLogger:
         self.logger.info(log_data)
     
     def error(self, msg, **kwargs):
+        # Skip building the record entirely when this level is filtered out
+        if not self.logger.isEnabledFor(logging.ERROR):
+            return
+        
         # Add trace context
         span = trace.get_current_span()
         span_context = span.get_span_context()